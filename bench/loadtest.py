@@ -0,0 +1,404 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Load-test harness for gygax.
+============================
+
+Starts a fake IRC server and local stand-ins for the Scryfall and Twitch APIs,
+runs the real bot (``scripts/gygax``) in a subprocess against them and replays
+synthetic or recorded channel traffic into it at a configurable rate.
+
+Reports throughput, command-to-reply latency, PING-to-PONG latency and the
+memory usage of the bot and, separately, of its child processes such as
+workers running isolated commands. Run from the repository root, e.g.::
+
+    python3 bench/loadtest.py --rate 200 --count 5000
+    python3 bench/loadtest.py --replay traffic.log --json
+
+Commands are sent as private messages from a unique nick each, so that the
+bot's first reply to that nick can be matched to the command that caused it.
+Recorded traffic can be a raw IRC log or a file written by the [traffic]
+logging section; only lines received by the bot are replayed.
+"""
+
+import argparse
+import configparser
+import http.server
+import itertools
+import json
+import os
+import os.path
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib import parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from gygax import irc
+
+NICK = "gygax"
+CHANNEL = "#bench"
+
+# Synthetic workload: (weight, text) pairs for commands and channel chatter.
+COMMANDS = (
+        (30, ".roll 3d6"),
+        (10, ".roll stats"),
+        (10, ".dbc"),
+        (10, ".mtg Black Lotus"),
+        (5, ".mtgtext Lightning Bolt"),
+        (5, ".mtgq t:dragon"),
+        (5, ".twitch check somestreamer"),
+    )
+CHATTER = (
+        "anyone up for a game tonight?",
+        "brb",
+        "that card is completely busted",
+        "lol",
+    )
+
+class FakeAPI(http.server.BaseHTTPRequestHandler):
+
+    """Serves canned Scryfall and Twitch responses."""
+
+    delay = 0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        url = parse.urlsplit(self.path)
+        query = parse.parse_qs(url.query)
+        handler = getattr(self, "_" + url.path.strip("/").replace("/", "_"),
+                None)
+        if handler:
+            handler(query)
+        else:
+            self._send(404, {"error": "not found"})
+
+    def _send(self, status, body, content_type="application/json"):
+        if content_type == "application/json":
+            body = json.dumps(body)
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _card(self, name):
+        return {"name": name, "scryfall_uri":
+                "https://scryfall.com/card/xyz/1/" + parse.quote(name)}
+
+    def _scryfall_cards_named(self, query):
+        name = query.get("fuzzy", [""])[0]
+        if query.get("format", ["json"])[0] == "text":
+            self._send(200, "{}\n{{R}}\nInstant\nDeals 3 damage.\n".format(name),
+                    "text/plain")
+        else:
+            self._send(200, self._card(name))
+
+    def _scryfall_cards_search(self, query):
+        q = query.get("q", [""])[0]
+        self._send(200, {"total_cards": 5,
+                "data": [self._card("{} {}".format(q, i)) for i in range(5)]})
+
+    def _twitch_users(self, query):
+        users = query.get("login", []) + query.get("id", [])
+        self._send(200, {"data": [{"id": user, "login": user,
+                "display_name": user.capitalize()} for user in users]})
+
+    def _twitch_streams(self, query):
+        self._send(200, {"data": [{"user_id": user, "user_name": user,
+                "game_id": "1", "title": "bench stream"}
+                for user in query.get("user_id", [])]})
+
+    def _twitch_games(self, query):
+        self._send(200, {"data": [{"id": game, "name": "Magic"}
+                for game in query.get("id", [])]})
+
+    def log_message(self, *args):
+        pass  # Keep the report readable.
+
+class FakeServer:
+
+    """A minimal IRC server which accepts a single client connection and
+    records the times at which the bot replies and answers PINGs.
+    """
+
+    def __init__(self):
+        self._listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self._listener.getsockname()[1]
+        self._sock = None
+        self._lock = threading.Lock()
+        self.joined = threading.Event()
+        self.replies = {}  # nick -> time of first reply
+        self.reply_count = 0
+        self.pongs = {}    # token -> time of PONG
+
+    def accept(self, timeout):
+        self._listener.settimeout(timeout)
+        self._sock, _ = self._listener.accept()
+        self._listener.close()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def send(self, line):
+        with self._lock:
+            self._sock.sendall(line.encode("utf-8") + b"\r\n")
+
+    def close(self):
+        if self._sock:
+            # The reader's file object keeps the socket open otherwise.
+            self._sock.shutdown(socket.SHUT_RDWR)
+            self._sock.close()
+
+    def _read(self):
+        for line in self._sock.makefile("rb"):
+            now = time.perf_counter()
+            prefix, command, params = irc._parse_message(
+                    line.rstrip(b"\r\n").decode("utf-8", "replace"))
+            if command == "USER":
+                for numeric in ("001", "002", "003", "004"):
+                    self.send(":bench {} {} :hello".format(numeric, NICK))
+            elif command == "JOIN":
+                self.send(":{0}!{0}@bench JOIN {1}".format(NICK, params[0]))
+                self.joined.set()
+            elif command == "PONG":
+                self.pongs.setdefault(params[-1], now)
+            elif command == "PRIVMSG":
+                self.reply_count += 1
+                self.replies.setdefault(params[0], now)
+
+def synthetic(count, chatter, seed):
+    rnd = random.Random(seed)
+    weights, texts = zip(*COMMANDS)
+    for _ in range(count):
+        if rnd.random() < chatter:
+            yield None, rnd.choice(CHATTER)
+        else:
+            yield rnd.choices(texts, weights)[0], None
+
+def replay(path):
+    """Yields (command, line) pairs from a recorded log."""
+    with open(path, encoding="utf-8") as fp:
+        for line in fp:
+            line = line.rstrip("\r\n")
+            if " >> " in line:
+                continue  # Sent by the bot, not received.
+            if " << " in line:
+                line = line.split(" << ", 1)[1]
+            if not line:
+                continue
+            prefix, command, params = irc._parse_message(line)
+            if command == "PRIVMSG" and params and len(params) > 1 \
+                    and params[-1].startswith("."):
+                yield params[-1], None
+            elif command not in ("PING", "PONG") and not command.isdigit():
+                yield None, line
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def rss(pid):
+    """Returns the current and peak resident set size of pid in kB."""
+    try:
+        with open("/proc/{}/status".format(pid)) as fp:
+            status = dict(line.split(":", 1) for line in fp)
+        return (int(status["VmRSS"].split()[0]),
+                int(status["VmHWM"].split()[0]))
+    except (OSError, KeyError):
+        return None, None
+
+def children(pid):
+    """Returns the pids of all live descendants of pid."""
+    pids = []
+    try:
+        tasks = os.listdir("/proc/{}/task".format(pid))
+    except OSError:
+        return pids
+    for task in tasks:
+        try:
+            with open("/proc/{}/task/{}/children".format(pid, task)) as fp:
+                direct = [int(child) for child in fp.read().split()]
+        except OSError:
+            continue
+        for child in direct:
+            pids += [child] + children(child)
+    return pids
+
+def children_rss(pid):
+    """Returns the summed current and peak resident set size in kB of the
+    live descendants of pid, such as worker processes.
+    """
+    current = peak = 0
+    for child in children(pid):
+        child_current, child_peak = rss(child)
+        current += child_current or 0
+        peak += child_peak or 0
+    return current, peak
+
+def write_config(path, port, api_port, modules, tmpdir):
+    api = "http://127.0.0.1:{}".format(api_port)
+    config = configparser.ConfigParser()
+    config["bot"] = {"nick": NICK, "real": "gygax load test",
+            "server": "127.0.0.1", "port": str(port),
+            "channels": CHANNEL, "modules": modules,
+            "state": os.path.join(tmpdir, "state.json")}
+    config["module_scryfall"] = {"api_url": api + "/scryfall"}
+    config["module_twitch"] = {"client_id": "bench",
+            "api_url": api + "/twitch"}
+    with open(path, "w") as fp:
+        config.write(fp)
+
+def run(args, tmpdir):
+    FakeAPI.delay = args.http_delay / 1000
+    api = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeAPI)
+    api.daemon_threads = True
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+
+    server = FakeServer()
+    config = os.path.join(tmpdir, "gygax.ini")
+    write_config(config, server.port, api.server_address[1], args.modules,
+            tmpdir)
+
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    stderr = open(os.path.join(tmpdir, "gygax.log"), "w")
+    bot = subprocess.Popen([sys.executable, "-W", "ignore",
+            os.path.join(ROOT, "scripts", "gygax"), "-c", config],
+            env=env, stderr=stderr)
+    try:
+        server.accept(args.timeout)
+        if not server.joined.wait(args.timeout):
+            raise RuntimeError("bot did not join " + CHANNEL)
+        rss_start, _ = rss(bot.pid)
+
+        if args.replay:
+            traffic = replay(args.replay)
+        else:
+            traffic = synthetic(args.count, args.chatter, args.seed)
+
+        sent = {}  # nick -> time command was sent
+        pings = {}
+        lines = 0
+        ping_seq = itertools.count()
+        start = next_ping = time.perf_counter()
+        for i, (command, line) in enumerate(traffic):
+            now = time.perf_counter()
+            if args.rate:
+                target = start + i / args.rate
+                if target > now:
+                    time.sleep(target - now)
+                    now = target
+            if args.ping_interval and now >= next_ping:
+                token = "bench{}".format(next(ping_seq))
+                pings[token] = time.perf_counter()
+                server.send("PING :" + token)
+                next_ping = now + args.ping_interval
+            if command:
+                nick = "u{}".format(i)
+                sent[nick] = time.perf_counter()
+                server.send(":{0}!{0}@bench PRIVMSG {1} :{2}".format(
+                    nick, NICK, command))
+            else:
+                if not line.startswith(":"):
+                    line = ":chatter!chatter@bench PRIVMSG {} :{}".format(
+                            CHANNEL, line)
+                server.send(line)
+            lines += 1
+        send_time = time.perf_counter() - start
+
+        # Wait for outstanding replies and a final PONG.
+        token = "bench{}".format(next(ping_seq))
+        pings[token] = time.perf_counter()
+        server.send("PING :" + token)
+        deadline = time.perf_counter() + args.timeout
+        while time.perf_counter() < deadline and (
+                token not in server.pongs or len(server.replies) < len(sent)):
+            time.sleep(0.01)
+        total_time = time.perf_counter() - start
+        rss_end, rss_peak = rss(bot.pid)
+        children_end, children_peak = children_rss(bot.pid)
+    finally:
+        server.close()
+        try:
+            bot.wait(5)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+            print("bot did not exit, killed", file=sys.stderr)
+        api.shutdown()
+        stderr.close()
+
+    latencies = [(server.replies[nick] - t) * 1000
+            for nick, t in sent.items() if nick in server.replies]
+    ping_latencies = [(server.pongs[token] - t) * 1000
+            for token, t in pings.items() if token in server.pongs]
+    return {
+            "lines": lines,
+            "commands": len(sent),
+            "replies": server.reply_count,
+            "unanswered": len(sent) - len(latencies),
+            "send_seconds": send_time,
+            "total_seconds": total_time,
+            "lines_per_second": lines / total_time,
+            "commands_per_second": len(latencies) / total_time,
+            "latency_p50_ms": percentile(latencies, 50),
+            "latency_p99_ms": percentile(latencies, 99),
+            "latency_max_ms": max(latencies, default=float("nan")),
+            "pings": len(pings),
+            "pongs_missing": len(pings) - len(ping_latencies),
+            "ping_p50_ms": percentile(ping_latencies, 50),
+            "ping_p99_ms": percentile(ping_latencies, 99),
+            "ping_max_ms": max(ping_latencies, default=float("nan")),
+            "rss_start_kb": rss_start,
+            "rss_end_kb": rss_end,
+            "rss_peak_kb": rss_peak,
+            "children_rss_end_kb": children_end,
+            "children_rss_peak_kb": children_peak,
+        }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Load-test the gygax IRC bot against a fake server.")
+    parser.add_argument("--rate", type=float, default=100,
+            help="lines per second to send, 0 for as fast as possible")
+    parser.add_argument("--count", type=int, default=2000,
+            help="number of synthetic lines to send")
+    parser.add_argument("--chatter", type=float, default=0.5,
+            help="fraction of synthetic lines that are not commands")
+    parser.add_argument("--seed", type=int, default=0,
+            help="random seed for the synthetic workload")
+    parser.add_argument("--replay", metavar="<log>",
+            help="replay recorded traffic instead of a synthetic workload")
+    parser.add_argument("--modules", default="roll dbc scryfall twitch",
+            help="modules to load into the bot")
+    parser.add_argument("--ping-interval", type=float, default=1,
+            help="seconds between PINGs sent to the bot, 0 to disable")
+    parser.add_argument("--http-delay", type=float, default=0,
+            help="milliseconds the fake HTTP APIs wait before responding")
+    parser.add_argument("--timeout", type=float, default=30,
+            help="seconds to wait for the bot to connect and reply")
+    parser.add_argument("--json", action="store_true",
+            help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="gygax-bench-") as tmpdir:
+        results = run(args, tmpdir)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    for key, value in results.items():
+        if isinstance(value, float):
+            value = "{:.2f}".format(value)
+        print("{:<22}{}".format(key, value))
+
+if __name__ == "__main__":
+    main()
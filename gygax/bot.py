@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import asyncore
+import collections
 import logging
+import socket
 
 import gygax.irc
 import gygax.modules
+import gygax.state
+import gygax.worker
 
 log = logging.getLogger(__name__)
 
@@ -11,8 +16,18 @@ class Bot(gygax.irc.Client):
 
     """A concrete implementation of :class:`gygax.irc.Client` which supports
     configuration and dynamically loadable modules.
+
+    Commands of modules which set ``isolated = True``, or command functions
+    with an ``isolated`` attribute set to ``True``, are run in a pool of worker
+    processes (see :mod:`gygax.worker`) instead of the IRC client's process.
     """
 
+    @property
+    def state(self):
+        """The :class:`gygax.state.Store` modules can keep persistent state in.
+        """
+        return self._state
+
     def __init__(self, **config):
         """Creates a new IRC bot and initializes it from config."""
         super().__init__(config["bot"]["nick"], config["bot"]["real"])
@@ -20,6 +35,12 @@ class Bot(gygax.irc.Client):
         self._commands = {}
         self._ticks = {}
         self._tick_count = 0
+        self._state = gygax.state.Store(config["bot"].get("state") or None)
+
+        self._isolated = set()
+        self._workers = None
+        self._outgoing = collections.deque()
+        self._waker = None
 
         for module in config["bot"].get("modules", "").split():
             self._load_module(module)
@@ -35,10 +56,18 @@ class Bot(gygax.irc.Client):
             autosend = map(lambda s: s.strip(), autosend)
             autosend = filter(None, autosend)
 
-        super().run((config["server"], int(config["port"])),
-                channels=config.get("channels", "").split() or None,
-                password=config.get("password"),
-                autosend=autosend or None)
+        try:
+            super().run((config["server"], int(config["port"])),
+                    channels=config.get("channels", "").split() or None,
+                    password=config.get("password"),
+                    autosend=autosend or None)
+        finally:
+            self._stop_workers()
+            self.state.close()
+
+    def handle_close(self):
+        super().handle_close()
+        self._stop_workers()  # Let the asyncore loop exit.
 
     def _load_module(self, name):
         try:
@@ -54,31 +83,43 @@ class Bot(gygax.irc.Client):
         self._ticks.pop(module.__name__, None)
         if hasattr(module, "reset"):
             module.reset(self, self._config.get("module_" + module.__name__))
+        isolated = False
         for _, func in vars(module).items():
             if hasattr(func, "command"):
                 log.debug("binding {} to {}".format(func.command, func.__name__))
                 self._commands[func.command] = func
+                if getattr(func, "isolated", getattr(module, "isolated", False)):
+                    self._isolated.add(func.command)
+                    isolated = True
+                else:
+                    self._isolated.discard(func.command)
             if hasattr(func, "tick"):
                 log.debug("calling {} after every {} tick(s)".format(func.__name__, func.tick))
                 if module in self._ticks:
                     self._ticks[module.__name__].append(func)
                 else:
                     self._ticks[module.__name__] = [func]
+        if isolated and self._workers:
+            # Workers have the previous version of module loaded.
+            self._workers.recycle()
 
     def handle(self, sender, recipient, text):
+        if recipient == self.nick:
+            target, _, _ = gygax.irc.split_name(sender)
+        else:
+            target = recipient
         def reply(text):
-            if recipient == self.nick:
-                nick, _, _ = gygax.irc.split_name(sender)
-                self.message(nick, text)
-            else:
-                self.message(recipient, text)
+            self.message(target, text)
         self.reply = reply
 
         for command, func in self._commands.items():
             if text == command or text.startswith(command + " "):
                 args = text[len(command):].strip()
                 try:
-                    func(self, sender, args)
+                    if command in self._isolated:
+                        self._submit(command, func, sender, target, args)
+                    else:
+                        func(self, sender, args)
                 except Exception as e:
                     log.exception("{} failed: {}".format(command, e))
                     self.reply("something went wrong")
@@ -94,3 +135,69 @@ class Bot(gygax.irc.Client):
                         func(self)
                     except Exception as e:
                         log.exception("ticking {}.{} failed: {}".format(module, func.__name__, e))
+
+    # The following functions manage the worker processes which run isolated
+    # commands (see gygax.worker.Pool). Workers are started on the first
+    # isolated command.
+
+    def _submit(self, command, func, sender, target, args):
+        if self._workers is None:
+            config = self._config["bot"]
+            workers = config.get("workers")
+            self._waker = _Waker(self._deliver)
+            self._workers = gygax.worker.Pool(
+                    size=int(workers) if workers else None,
+                    max_tasks=int(config.get("worker_tasks", 100)),
+                    timeout=float(config.get("worker_timeout") or 60) or None,
+                    deliver=self._send_later)
+        module = func.__module__
+        self._workers.submit(command, self.nick, module, func.__name__,
+                dict(self._config.get("module_" + module) or {}),
+                sender, target, args)
+
+    def _stop_workers(self):
+        if self._workers:
+            self._workers.close()
+            self._workers = None
+        if self._waker:
+            self._waker.close()
+            self._waker = None
+
+    def _send_later(self, recipient, text):
+        # Called from other threads: only the asyncore loop may send messages.
+        self._outgoing.append((recipient, text))
+        waker = self._waker
+        if waker:
+            waker.wake()
+
+    def _deliver(self):
+        while self._outgoing:
+            self.message(*self._outgoing.popleft())
+
+
+class _Waker(asyncore.dispatcher):
+
+    """Wakes up the asyncore loop to call callback from another thread."""
+
+    def __init__(self, callback):
+        self._callback = callback
+        sock, self._wake_sock = socket.socketpair()
+        self._wake_sock.setblocking(False)
+        super().__init__(sock)
+
+    def wake(self):
+        try:
+            self._wake_sock.send(b"\0")
+        except OSError:
+            pass  # Already woken up or closed.
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self._callback()
+
+    def close(self):
+        super().close()
+        self._wake_sock.close()
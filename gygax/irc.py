@@ -16,11 +16,30 @@ to build IRC bots or custom clients.
 
 import asynchat
 import asyncore
+import itertools
 import logging
 import time
 
 log = logging.getLogger(__name__)
 
+# Raw protocol lines are logged to a separate logger so that they can be
+# sampled and written to their own sink without enabling debug logging for the
+# rest of the client. It does not propagate, so that enabling debug logging
+# does not log every line twice.
+traffic_log = logging.getLogger(__name__ + ".traffic")
+traffic_log.propagate = False
+_traffic_sample = itertools.repeat(0)
+
+def sample_traffic(n):
+    """Log only every n-th line of raw traffic to :data:`traffic_log`.
+
+    Lines are skipped before a log record is created for them.
+    """
+    if n < 1:
+        raise ValueError("traffic sample must be at least 1, got {}".format(n))
+    global _traffic_sample
+    _traffic_sample = itertools.cycle(range(n))
+
 class Client(asynchat.async_chat):
 
     """An abstract class which implements a minimal, but functional subset of
@@ -99,18 +118,26 @@ class Client(asynchat.async_chat):
             message_parts += args
         self._push(" ".join(message_parts))
 
-    def _push(self, message):
-        message = message.encode("utf-8")
-        if len(message) > 510:
+    def _push(self, message, secret=False):
+        data = message.encode("utf-8")
+        if len(data) > 510:
             newlen = 510
-            while message[newlen] & 0xc0 == 0x80:  # UTF-8 continuation byte
+            while data[newlen] & 0xc0 == 0x80:  # UTF-8 continuation byte
                 newlen -= 1
-            log.warning("truncating message from {} to {} bytes".format(
-                len(message), newlen))
-            message = message[:newlen]
-
-        log.debug("pushing {}".format(message.decode("utf-8")))
-        self.push(message + b"\r\n")
+            log.warning("truncating message from %d to %d bytes",
+                    len(data), newlen)
+            data = data[:newlen]
+            message = data.decode("utf-8")
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("pushing %s", message)
+        if traffic_log.isEnabledFor(logging.DEBUG) and not next(_traffic_sample):
+            if secret or message.startswith("PASS "):
+                # Keep passwords out of the traffic log.
+                traffic_log.debug(">> %s ***", message.split(" ", 1)[0])
+            else:
+                traffic_log.debug(">> %s", message)
+        self.push(data + b"\r\n")
 
     def message(self, recipient, text):
         """Send a private message to the IRC network.
@@ -128,12 +155,17 @@ class Client(asynchat.async_chat):
         message = b"".join(self._incoming).decode("utf-8")
         self._incoming = []
 
-        log.debug("received {}".format(message))
-        prefix, command, params = _parse_message(message)
-        def _ignore(*args):
-            log.debug("ignoring unhandled command {}".format(command))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("received %s", message)
+        if traffic_log.isEnabledFor(logging.DEBUG) and not next(_traffic_sample):
+            traffic_log.debug("<< %s", message)
 
-        getattr(self, "_on_" + command, _ignore)(prefix, params)
+        prefix, command, params = _parse_message(message)
+        handler = getattr(self, "_on_" + command, None)
+        if handler:
+            handler(prefix, params)
+        elif log.isEnabledFor(logging.DEBUG):
+            log.debug("ignoring unhandled command %s", command)
 
     def join(self, *channels):
         """Join IRC channels.
@@ -191,7 +223,7 @@ class Client(asynchat.async_chat):
         # The server sends Replies 001 to 004 upon successful registration.
         log.info("registered")
         for message in self._autosend:
-            self._push(message)
+            self._push(message, secret=True)  # May contain credentials.
             time.sleep(1)  # give the server time to handle the message
         self.join(*self.channels)
         self._channels = set()  # Will be filled by _on_JOIN with channels
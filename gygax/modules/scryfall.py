@@ -9,6 +9,14 @@ import codecs
 import json
 from urllib import error, parse, request
 
+api_url = None
+
+def reset(bot, config):
+    global api_url
+    api_url = "https://api.scryfall.com"
+    if config:
+        api_url = config.get("api_url", api_url)
+
 def mtg(bot, sender, text):
     def callback(resp):
         data = json.load(codecs.getreader("utf-8")(resp))
@@ -32,7 +40,7 @@ def mtgtext(bot, sender, text):
 mtgtext.command = ".mtgtext"
 
 def named(card, fmt, callback):
-    req = request.Request("https://api.scryfall.com/cards/named?{}".format(
+    req = request.Request("{}/cards/named?{}".format(api_url,
         parse.urlencode({"fuzzy": card, "format": fmt})))
     try:
         with request.urlopen(req) as resp:
@@ -43,7 +51,7 @@ def named(card, fmt, callback):
 
 def mtgq(bot, sender, text):
     params = parse.urlencode({"q": text})
-    req = request.Request("https://api.scryfall.com/cards/search?{}".format(params))
+    req = request.Request("{}/cards/search?{}".format(api_url, params))
     try:
         with request.urlopen(req) as resp:
             data = json.load(codecs.getreader("utf-8")(resp))
@@ -15,8 +15,9 @@ from gygax import irc
 
 log = logging.getLogger("gygax.modules.twitch")
 
+api_url = None
 client_id = None
-following_db = None
+state = None
 
 def reset(bot, config):
     if not config or "client_id" not in config:
@@ -24,15 +25,22 @@ def reset(bot, config):
     global client_id
     client_id = config["client_id"]
 
-    global following_db
-    following_db = config.get("following_db")
-    if following_db:
+    global api_url
+    api_url = config.get("api_url", "https://api.twitch.tv/helix")
+
+    global state
+    state = bot.state
+    following = state.get("twitch.following")
+    if following is None and config.get("following_db"):
+        # Import users followed before module state was kept in bot.state.
         try:
-            with open(following_db) as fp:
-                for user_id, nicks in json.load(fp).items():
-                    watchdog._following[user_id].update(nicks)
+            with open(config["following_db"]) as fp:
+                following = json.load(fp)
         except FileNotFoundError:
             pass  # Nothing saved yet.
+    for user_id, nicks in (following or {}).items():
+        watchdog._following[user_id].update(nicks)
+    watchdog._last_online = set(state.get("twitch.last_online", []))
 
 def twitch(bot, sender, text):
     words = text.split()
@@ -94,16 +102,17 @@ def watchdog(bot):
         for user_id, stream in augment_streams(fresh).items():
             for target in watchdog._following[user_id]:
                 bot.message(target, format_stream(stream))
-        watchdog._last_online = set(online.keys())
+        if online.keys() != watchdog._last_online:
+            watchdog._last_online = set(online.keys())
+            state.set("twitch.last_online", list(watchdog._last_online))
 
 watchdog._following = collections.defaultdict(set)
 watchdog._last_online = set()
 watchdog.tick = 1
 
 def save_following():
-    if following_db:
-        with open(following_db, "w") as fp:
-            json.dump({k: list(v) for k, v in watchdog._following.items()}, fp)
+    state.set("twitch.following",
+            {k: list(v) for k, v in watchdog._following.items()})
 
 def augment_streams(streams):
     # Resolve game ids to game names.
@@ -139,8 +148,8 @@ def query(what, field, *values, index=None):
     # requests to 100 responses.
 
     filters = [(field, value) for value in values]
-    req = request.Request("https://api.twitch.tv/helix/{}?{}".format(
-        what, parse.urlencode(filters + [("limit", 100)])))
+    req = request.Request("{}/{}?{}".format(
+        api_url, what, parse.urlencode(filters + [("limit", 100)])))
     req.add_header("Client-ID", client_id)
 
     log.debug(req.full_url)
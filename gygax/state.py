@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""
+:mod:`gygax.state` --- Persistent module state.
+===============================================
+
+:mod:`gygax.state` implements a small key-value store which modules can use to
+keep state across restarts. The bot provides an instance to modules as
+:attr:`gygax.bot.Bot.state`.
+
+Values must be serializable as JSON. Changes are kept in memory and written to
+disk by a background thread at most once per flush delay, so that modules never
+block the IRC loop on disk I/O. The file is replaced atomically, so a crash
+leaves either the old or the new state on disk, but never a partial file.
+"""
+
+import json
+import logging
+import os
+import os.path
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+_MAX_BACKOFF = 60  # Maximum seconds between retries of failed writes.
+
+class Store:
+
+    """A persistent key-value store.
+
+    :param str path: The file to load state from and save it to. If ``None``,
+        state is only kept in memory.
+    :param float delay: The number of seconds to wait after a change before
+        writing state to disk. Changes made meanwhile are written together.
+    """
+
+    def __init__(self, path=None, delay=1.0):
+        """Creates a new store and loads any state saved at path."""
+        self._path = path and os.path.expanduser(path)
+        self._delay = delay
+        self._data = {}
+        self._dirty = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._warned = False
+        self._failing = False  # Whether the last write failed.
+        self._backoff = delay
+
+        if self._path:
+            self._check_dir()
+        if self._path:
+            self._load()
+
+    def get(self, key, default=None):
+        """Return the value for key, or default if key is not set."""
+        with self._cond:
+            return self._data.get(key, default)
+
+    def set(self, key, value):
+        """Set the value for key and schedule a write to disk.
+
+        The value must not be modified after it has been set, as it may be
+        serialized at any time by the background thread.
+        """
+        with self._cond:
+            self._data[key] = value
+            self._changed()
+        if self._closed:
+            self.flush()  # The background thread has already stopped.
+
+    def delete(self, key):
+        """Remove key from the store, if present."""
+        with self._cond:
+            if key not in self._data:
+                return
+            del self._data[key]
+            self._changed()
+        if self._closed:
+            self.flush()  # The background thread has already stopped.
+
+    def flush(self):
+        """Write any pending changes to disk immediately."""
+        with self._write_lock:
+            with self._cond:
+                if not self._dirty:
+                    return
+                data = json.dumps(self._data)
+                self._dirty = False
+            try:
+                _atomic_write(self._path, data)
+            except OSError as e:
+                with self._cond:
+                    self._dirty = True
+                    # Retry less and less often, without flooding the log.
+                    self._backoff = min(self._backoff * 2, _MAX_BACKOFF)
+                    if self._failing:
+                        return
+                    self._failing = True
+                log.error("failed to save state to {}, will keep retrying: "
+                        "{}".format(self._path, e))
+                return
+            with self._cond:
+                if self._failing:
+                    log.info("saved state to {}".format(self._path))
+                self._failing = False
+                self._backoff = self._delay
+
+    def close(self):
+        """Stop the background thread and write any pending changes."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def _changed(self):
+        # Must be called with self._cond held.
+        if not self._path:
+            if not self._warned:
+                log.warning("no state file configured, module state will be "
+                        "lost on restart")
+                self._warned = True
+            return
+        if self._dirty:
+            return
+        self._dirty = True
+        if self._thread is None and not self._closed:
+            self._thread = threading.Thread(target=self._run,
+                    name="gygax-state", daemon=True)
+            self._thread.start()
+        self._cond.notify()
+
+    def _check_dir(self):
+        directory = os.path.dirname(self._path) or "."
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            log.error("cannot create state directory, keeping state in "
+                    "memory only: {}".format(e))
+            self._path = None
+            self._warned = True
+            return
+        if not os.access(directory, os.W_OK):
+            log.error("state directory {} is not writable, changes will be "
+                    "lost on restart".format(directory))
+            self._failing = True  # Reported once here, not on every write.
+
+    def _load(self):
+        try:
+            with open(self._path, encoding="utf-8") as fp:
+                data = json.load(fp)
+            if not isinstance(data, dict):
+                raise ValueError("expected a JSON object, got {}".format(
+                    type(data).__name__))
+            self._data = data
+        except FileNotFoundError:
+            pass  # Nothing saved yet.
+        except OSError as e:
+            # Do not overwrite state that merely could not be read.
+            log.error("cannot load state from {}, keeping state in memory "
+                    "only: {}".format(self._path, e))
+            self._path = None
+            self._warned = True
+        except ValueError as e:
+            log.error("corrupt state in {}, starting empty: {}".format(
+                self._path, e))
+            try:
+                os.replace(self._path, self._path + ".corrupt")
+            except OSError as e:
+                log.error("failed to move corrupt state aside: {}".format(e))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._dirty and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return  # close() writes the final state.
+                self._cond.wait(self._backoff)  # Batch further changes.
+                if self._closed:
+                    return
+            self.flush()
+
+
+def _atomic_write(path, data):
+    """Replaces the file at path with data without leaving partial files."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+            prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+    # Make the rename itself durable.
+    fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+"""
+:mod:`gygax.worker` --- Process-isolated command execution.
+===========================================================
+
+:mod:`gygax.worker` runs commands of modules marked as isolated in worker
+processes, so that CPU-heavy commands, hangs or crashes do not stall the IRC
+client.
+
+Commands in worker processes receive a stand-in for the bot which only
+supports the :attr:`nick` attribute and the :meth:`reply` and :meth:`message`
+methods. Replies are streamed back to the bot as they are made. Modules are
+loaded and reset once per worker process, with the bot's :attr:`state`
+unavailable.
+
+Each worker process talks to the bot over its own pipe, so that a worker
+which is terminated after timing out cannot corrupt the others'
+communication.
+"""
+
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time
+import traceback
+
+import gygax.modules
+
+log = logging.getLogger(__name__)
+
+class Pool:
+
+    """Runs commands in a set of worker processes.
+
+    :param int size: The maximum number of worker processes. Defaults to the
+        number of CPUs.
+    :param int max_tasks: The number of commands after which a worker process
+        is replaced.
+    :param float timeout: The number of seconds after which a command is
+        considered hung and its worker process is terminated. ``None`` to
+        wait forever.
+    :param deliver: A function ``deliver(recipient, text)`` which is called
+        from the pool's thread to send messages on behalf of commands.
+    """
+
+    def __init__(self, size=None, max_tasks=100, timeout=None, deliver=None):
+        """Creates a new pool. Worker processes are started on demand."""
+        self._size = size or os.cpu_count() or 1
+        self._max_tasks = max_tasks
+        self._timeout = timeout
+        self._deliver = deliver
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._workers = []
+        self._idle = []
+        self._busy = {}  # task id -> _Task
+        self._pending = []
+        self._generation = 0
+        self._closed = False
+
+        # Wakes up the pool's thread when a worker is added.
+        self._wake_recv, self._wake_send = self._context.Pipe(duplex=False)
+        self._thread = threading.Thread(target=self._run, name="gygax-workers",
+                daemon=True)
+        self._thread.start()
+
+    def submit(self, command, nick, module, name, config, sender, target, args):
+        """Schedule command function name from module to run in a worker."""
+        task = _Task(next(self._ids), command, target,
+                (nick, module, name, config, sender, target, args))
+        with self._lock:
+            self._pending.append(task)
+            self._dispatch()
+
+    def recycle(self):
+        """Replace all worker processes once they finish their commands."""
+        with self._lock:
+            self._generation += 1
+            for worker in self._idle:
+                self._retire(worker)
+            self._idle = []
+
+    def close(self):
+        """Terminate all worker processes and stop the pool's thread."""
+        with self._lock:
+            self._closed = True
+            for worker in self._workers:
+                worker.process.terminate()
+        self._wake_send.send(None)
+        self._thread.join()
+        for worker in self._workers:
+            worker.process.join()
+
+    # The following functions must be called with self._lock held.
+
+    def _dispatch(self):
+        while self._pending and not self._closed:
+            if self._idle:
+                worker = self._idle.pop()
+            elif len(self._workers) < self._size:
+                worker = self._start()
+            else:
+                return
+            task = self._pending.pop(0)
+            task.worker = worker
+            if self._timeout:
+                task.deadline = time.monotonic() + self._timeout
+            self._busy[task.id] = task
+            worker.conn.send((task.id,) + task.request)
+
+    def _start(self):
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_main, args=(child_conn,),
+                name="gygax-worker", daemon=True)
+        process.start()
+        child_conn.close()
+        worker = _Worker(process, conn, self._generation)
+        self._workers.append(worker)
+        self._wake_send.send(None)  # Start listening to the new worker.
+        return worker
+
+    def _retire(self, worker):
+        self._workers.remove(worker)
+        try:
+            worker.conn.send(None)
+        except OSError:
+            pass  # Already gone.
+        worker.conn.close()
+
+    def _kill(self, worker, reason):
+        # Fail the worker's command and replace it with a fresh process.
+        for task in list(self._busy.values()):
+            if task.worker is worker:
+                self._fail(task, reason)
+        self._workers.remove(worker)
+        worker.process.terminate()
+        worker.conn.close()
+
+    def _fail(self, task, error):
+        del self._busy[task.id]
+        log.error("{} failed: {}".format(task.command, error))
+        self._deliver(task.target, "something went wrong")
+
+    def _finish(self, task, error):
+        if error:
+            self._fail(task, error)
+        else:
+            del self._busy[task.id]
+        worker = task.worker
+        worker.tasks += 1
+        if worker.tasks >= self._max_tasks or \
+                worker.generation != self._generation:
+            self._retire(worker)
+        else:
+            self._idle.append(worker)
+
+    def _handle(self, worker):
+        try:
+            task_id, recipient, text = worker.conn.recv()
+        except (EOFError, OSError):
+            self._kill(worker, "worker process died")
+            return
+        task = self._busy.get(task_id)
+        if not task:
+            return  # Left over from a command which timed out.
+        if recipient:
+            self._deliver(recipient, text)
+        else:
+            self._finish(task, text)
+
+    def _expire(self):
+        now = time.monotonic()
+        for task in list(self._busy.values()):
+            if task.deadline and now > task.deadline:
+                self._kill(task.worker, "timed out after {} seconds".format(
+                    self._timeout))
+
+    def _run(self):
+        while True:
+            with self._lock:
+                conns = {worker.conn: worker for worker in self._workers}
+            ready = multiprocessing.connection.wait(
+                    list(conns) + [self._wake_recv], timeout=1)
+            with self._lock:
+                if self._closed:
+                    return
+                for conn in ready:
+                    if conn is self._wake_recv:
+                        conn.recv()
+                    elif conns[conn] in self._workers:
+                        self._handle(conns[conn])
+                self._expire()
+                self._dispatch()
+
+
+class _Worker:
+
+    def __init__(self, process, conn, generation):
+        self.process = process
+        self.conn = conn
+        self.generation = generation
+        self.tasks = 0
+
+
+class _Task:
+
+    def __init__(self, id, command, target, request):
+        self.id = id
+        self.command = command
+        self.target = target
+        self.request = request
+        self.worker = None
+        self.deadline = None
+
+
+class _Bot:
+
+    """Stands in for :class:`gygax.bot.Bot` in worker processes."""
+
+    state = None
+
+    def __init__(self, conn, task_id, nick, target):
+        self.nick = nick
+        self._conn = conn
+        self._task_id = task_id
+        self._target = target
+
+    def reply(self, text):
+        self.message(self._target, text)
+
+    def message(self, recipient, text):
+        self._conn.send((self._task_id, recipient, text))
+
+_modules = {}
+
+def _main(conn):
+    """The main loop of a worker process.
+
+    Replies are sent back as ``(task_id, recipient, text)`` and the end of a
+    command as ``(task_id, None, error)``, where error is ``None`` on success
+    or the formatted traceback if the command failed.
+    """
+    for task_id, nick, module, name, config, sender, target, args in \
+            iter(conn.recv, None):
+        bot = _Bot(conn, task_id, nick, target)
+        error = None
+        try:
+            if module not in _modules:
+                loaded = gygax.modules.load_module(module)
+                if hasattr(loaded, "reset"):
+                    loaded.reset(bot, config)
+                _modules[module] = loaded
+            getattr(_modules[module], name)(bot, sender, args)
+        except Exception:
+            error = traceback.format_exc()
+        conn.send((task_id, None, error))